@@ -1,8 +1,27 @@
 from functools import lru_cache
 
-from matplotlib import axes as Axes, pyplot as plt, rcParams, checkdep_usetex
+from matplotlib import (
+    axes as Axes,
+    checkdep_usetex,
+    pyplot as plt,
+    rc_context,
+    rcParams,
+)
 from matplotlib.dates import MonthLocator, DateFormatter
-from numpy import exp, linspace, log, polyfit, sqrt
+from matplotlib.ticker import PercentFormatter
+from numpy import (
+    arange,
+    concatenate,
+    diff,
+    dot,
+    exp,
+    histogram,
+    linspace,
+    log,
+    ndarray,
+    sort,
+    stack,
+)
 
 from door_stats import *
 
@@ -15,12 +34,38 @@ def is_tex_available():
 @lru_cache()
 def percent():
     """
-    Ensure percent sign is escaped iff tex is available
+    Ensure percent sign is escaped iff tex is available (for text that isn't formatted
+    by a PercentFormatter)
     """
     return r"\%" if is_tex_available() else "%"
 
 
-def plot_openness_by_hour(data: list, period: dict, ax: Axes):
+def decimate_min_max(x: ndarray, y: ndarray, num_chunks: int) -> (ndarray, ndarray):
+    """
+    Downsamples a series by keeping only the minimum and maximum of each chunk (in
+    their original order), which preserves the envelope of the series.
+
+    :param x: x-values of the series
+    :param y: y-values of the series
+    :param num_chunks: Number of chunks to split the series into
+    :return: The decimated x- and y-values
+    """
+    if num_chunks <= 0:
+        return x, y
+    chunk_len = len(y) // num_chunks
+    if chunk_len <= 2:
+        return x, y
+
+    # Find the min and max of each full chunk, and keep any leftover points as-is
+    num_chunked = chunk_len * num_chunks
+    chunks = y[:num_chunked].reshape(num_chunks, chunk_len)
+    min_max_idx = sort(stack((chunks.argmin(axis=1), chunks.argmax(axis=1)), axis=1))
+    min_max_idx += arange(num_chunks)[:, None] * chunk_len
+    idx = concatenate((min_max_idx.ravel(), arange(num_chunked, len(y))))
+    return x[idx], y[idx]
+
+
+def plot_openness_by_hour(data: tuple, period: dict, ax: Axes):
     """
     Plots the openness by hour from the raw data.
 
@@ -42,12 +87,12 @@ def plot_openness_by_hour(data: list, period: dict, ax: Axes):
     ax.set_xlim(1, num_hrs)
     ax.set_xticks(range(num_hrs + 1))
     ax.set_xticklabels([f"{t:02d}" for t in ax.get_xticks()])
-    ax.set_yticklabels([f"{o * 100:.1f}{percent()}" for o in ax.get_yticks()])
+    ax.yaxis.set_major_formatter(PercentFormatter(xmax=1.0, decimals=1))
     ax.set_ylabel("Andel åpen")
     ax.set_xlabel("Tid på døgnet")
 
 
-def plot_openness(data: list, period: dict, ax: Axes):
+def plot_openness(data: tuple, period: dict, ax: Axes):
     """
     Plots the openness from the raw data.
 
@@ -59,18 +104,24 @@ def plot_openness(data: list, period: dict, ax: Axes):
     # Get data
     datetimes, openness = get_openness(data, period)
 
+    # Rendering is limited by the width of the axes in pixels, so there's no point
+    # plotting more than a few points per pixel
+    width_px = int(ax.figure.dpi * ax.get_position().width * ax.figure.get_figwidth())
+    if len(openness) > 4 * width_px:
+        datetimes, openness = decimate_min_max(datetimes, openness, 2 * width_px)
+
     # Make filled line plot
     ax.fill_between(datetimes, openness)
 
     # Decorate axes
     ax.xaxis.set_major_locator(MonthLocator((1, 4, 7, 10), bymonthday=1))
     ax.xaxis.set_major_formatter(DateFormatter("%b '%y"))
-    ax.set_yticklabels([f"{o * 100:.0f}{percent()}" for o in ax.get_yticks()])
+    ax.yaxis.set_major_formatter(PercentFormatter(xmax=1.0, decimals=0))
     ax.set_ylabel("Andel åpen")
     ax.grid(linestyle="-.")
 
 
-def plot_openness_by_weekday(data: list, period: dict, ax: Axes):
+def plot_openness_by_weekday(data: tuple, period: dict, ax: Axes):
     """
     Plot the openness by weekday from the raw data.
 
@@ -87,15 +138,16 @@ def plot_openness_by_weekday(data: list, period: dict, ax: Axes):
     ax.bar(range(7), week_bins)
 
     # Plot averages
+    pct = percent()
     ax.text(
         2,
         weekday_avg * 1.05,
-        f"Gjennomsnitt ukedager: {weekday_avg * 100:.0f}{percent()}",
+        f"Gjennomsnitt ukedager: {weekday_avg * 100:.0f}{pct}",
     )
     ax.text(
         4.5,
         weekend_avg * 1.1,
-        f"Gjennomsnitt helgedager: {weekend_avg * 100:.0f}{percent()}",
+        f"Gjennomsnitt helgedager: {weekend_avg * 100:.0f}{pct}",
     )
     ax.plot((0, 5 - 1), (weekday_avg, weekday_avg), "k--")
     ax.plot((5, 7 - 1), (weekend_avg, weekend_avg), "k--")
@@ -104,9 +156,7 @@ def plot_openness_by_weekday(data: list, period: dict, ax: Axes):
     ax.set_xticklabels(
         ("", "Mandag", "Tirsdag", "Onsdag", "Torsdag", "Fredag", "Lørdag", "Søndag")
     )
-    ax.set_yticklabels(
-        [f"{openness * 100:.1f}{percent()}" for openness in ax.get_yticks()]
-    )
+    ax.yaxis.set_major_formatter(PercentFormatter(xmax=1.0, decimals=1))
     ax.set_ylabel("Andel åpen")
 
 
@@ -156,13 +206,11 @@ def plot_openness_by_weekday_by_semester(period: dict, ax: Axes):
     # Place legend and labels
     ax.legend(legend, loc="lower right")
     ax.set_xticklabels(("", "Mandag", "Tirsdag", "Onsdag", "Torsdag", "Fredag"))
-    ax.set_yticklabels(
-        [f"{openness * 100:.1f}{percent()}" for openness in ax.get_yticks()]
-    )
+    ax.yaxis.set_major_formatter(PercentFormatter(xmax=1.0, decimals=1))
     ax.set_ylabel("Andel åpen")
 
 
-def plot_visit_durations(data: list, ax: Axes):
+def plot_visit_durations(data: tuple, ax: Axes):
     """
     Plot the visit durations from the raw data.
 
@@ -181,14 +229,19 @@ def plot_visit_durations(data: list, ax: Axes):
 
     # Create histogram
     durations = get_visit_durations(data)
-    n, bins, _ = ax.hist(durations, bins=linspace(min_visit_s, max_visit_s, nbins))
+    n, bins = histogram(durations, bins=linspace(min_visit_s, max_visit_s, nbins))
+    ax.bar(bins[:-1], n, width=diff(bins), align="edge")
 
-    # Create regression line
+    # Create regression line (least squares fit of log(n), weighted by n)
     bin_width = (bins[fit_stop - 1] - bins[fit_start]) / (fit_start - fit_stop)
-    lin_fitting_bins = [b + bin_width / 2 for b in bins[fit_start:fit_stop]]
+    lin_fitting_bins = bins[fit_start:fit_stop] + bin_width / 2
     lin_fitting_n = n[fit_start:fit_stop]
-    [a, b] = polyfit(lin_fitting_bins, log(lin_fitting_n), 1, w=sqrt(lin_fitting_n))
-    fitted_n = [exp(b + a * t) for t in lin_fitting_bins]
+    t, y, w = lin_fitting_bins, log(lin_fitting_n), lin_fitting_n
+    s_w, s_t, s_y = w.sum(), dot(w, t), dot(w, y)
+    s_tt, s_ty = dot(w, t * t), dot(w, t * y)
+    a = (s_w * s_ty - s_t * s_y) / (s_w * s_tt - s_t ** 2)
+    b = (s_y - a * s_t) / s_w
+    fitted_n = exp(b + a * lin_fitting_bins)
     regression_line_opts = {"linestyle": "--", "color": "black", "linewidth": 2}
     regression_label_text = "y={:.0f}exp({:.6f}*t)".format(exp(b), a)
     regression_label_coords = (max_visit_s * 0.6, max(n) * 0.5)
@@ -201,48 +254,60 @@ def plot_visit_durations(data: list, ax: Axes):
     ax.set_yscale("log")
 
 
-def plot_all(data: list):
+def plot_all(data: tuple):
     """
     Plot everything based on the raw data.
 
     :param data: Raw data
     :return: None
     """
-    # Config
-    plt.figure(figsize=(15, 8))
-    grid_shape = (3, 2)
-    fine_grained_sampling_period = {"minutes": 1}
-
-    # Openness by week for the entire period
-    openness_ax = plt.subplot2grid(grid_shape, (0, 0), colspan=2)
-    plot_openness(data, {"days": 7}, openness_ax)
-
-    # Openness by hour for the entire period
-    openness_by_hour_ax = plt.subplot2grid(grid_shape, (1, 0))
-    plot_openness_by_hour(data, fine_grained_sampling_period, openness_by_hour_ax)
-
-    # Duration of visits
-    visit_duration_ax = plt.subplot2grid(grid_shape, (1, 1))
-    plot_visit_durations(data, visit_duration_ax)
-
-    # Openness by weekday
-    openness_by_weekday_ax = plt.subplot2grid(grid_shape, (2, 0))
-    plot_openness_by_weekday(data, fine_grained_sampling_period, openness_by_weekday_ax)
+    # Simplify unfilled paths (lines) by up to a pixel and rasterize long ones in
+    # chunks. Filled paths like fill_between are not simplified by Agg, so
+    # plot_openness decimates its data instead. The settings only apply to this plot.
+    rc = {
+        "path.simplify": True,
+        "path.simplify_threshold": 1.0,
+        "agg.path.chunksize": 10000,
+    }
+    with rc_context(rc):
+        # Config
+        fig, axes = plt.subplots(3, 2, figsize=(15, 8), constrained_layout=True)
+        fine_grained_sampling_period = {"minutes": 1}
+
+        # Openness by week for the entire period (spanning the whole top row)
+        grid_spec = axes[0, 0].get_gridspec()
+        for ax in axes[0]:
+            ax.remove()
+        openness_ax = fig.add_subplot(grid_spec[0, :])
+        plot_openness(data, {"days": 7}, openness_ax)
+
+        # Openness by hour for the entire period
+        openness_by_hour_ax = axes[1, 0]
+        plot_openness_by_hour(data, fine_grained_sampling_period, openness_by_hour_ax)
+
+        # Duration of visits
+        visit_duration_ax = axes[1, 1]
+        plot_visit_durations(data, visit_duration_ax)
+
+        # Openness by weekday
+        openness_by_weekday_ax = axes[2, 0]
+        plot_openness_by_weekday(
+            data, fine_grained_sampling_period, openness_by_weekday_ax
+        )
 
-    # Openness by weekday by semester
-    openness_by_weekday_by_semester_ax = plt.subplot2grid(grid_shape, (2, 1))
-    plot_openness_by_weekday_by_semester(
-        fine_grained_sampling_period, openness_by_weekday_by_semester_ax
-    )
+        # Openness by weekday by semester
+        openness_by_weekday_by_semester_ax = axes[2, 1]
+        plot_openness_by_weekday_by_semester(
+            fine_grained_sampling_period, openness_by_weekday_by_semester_ax
+        )
 
-    # Show the plot
-    plt.tight_layout()
-    plt.show()
+        # Show the plot
+        plt.show()
 
 
 if __name__ == "__main__":
     # Get data
-    data = list(get_rows())
+    data = get_rows()
 
     # Use LaTeX rendering if available
     rcParams["text.usetex"] = is_tex_available()
@@ -1,16 +1,39 @@
 """
 This module does door statistics.
 """
+from collections import OrderedDict
 from csv import reader
 from datetime import datetime, timedelta
-from dateutil.relativedelta import relativedelta
 from functools import lru_cache
-from os.path import dirname, realpath
-from types import GeneratorType
-
-# Index of the status and timestamp elements in a data row
-STATUS = 0
-TS = 1
+from glob import escape, glob
+from os import chmod, fdopen, remove, replace, stat, umask
+from os.path import dirname, isfile, realpath
+from tempfile import mkstemp
+from zipfile import BadZipFile
+
+from numpy import (
+    arange,
+    array,
+    bincount,
+    concatenate,
+    cumsum,
+    datetime64,
+    diff,
+    divide,
+    float32,
+    float64,
+    int8,
+    intp,
+    load,
+    ndarray,
+    repeat,
+    savez,
+    searchsorted,
+    split,
+    uint8,
+    where,
+    zeros,
+)
 
 # Value of a status when it is closed or open
 CLOSED = 0
@@ -18,191 +41,343 @@ OPEN = 1
 
 # CSV file location and data format
 DOOR_CSV_PATH = dirname(realpath(__file__)) + "/door.csv"
-DATETIME_FMT = "%Y-%m-%d %H:%M:%S"
+
+
+def to_seconds(dt: datetime) -> int:
+    """
+    Converts a datetime to the timestamp format used in the data (seconds since epoch)
+    """
+    return int(datetime64(dt, "s").astype("int64"))
 
 
 def limit_filter_func(start, stop):
     """
     Returns a function which filters the data by date.
     """
-    return lambda _, timestamp: start < timestamp < stop
+    start_s = to_seconds(start)
+    stop_s = to_seconds(stop)
+    return lambda _, timestamp: (start_s < timestamp) & (timestamp < stop_s)
 
 
 @lru_cache()
-def get_all_rows() -> list:
+def get_all_rows() -> (ndarray, ndarray):
     """
-    Returns all rows as a list of (status, datetime) tuples
+    Returns all rows as an array of timestamps (seconds since epoch) and an array of
+    statuses
+
+    The parsed data is cached in a .npz file next to door.csv, keyed on the
+    modification time and size of door.csv, so it is only parsed once.
     """
+    csv_stat = stat(DOOR_CSV_PATH)
+    cache_path = f"{DOOR_CSV_PATH}.{csv_stat.st_mtime_ns}.{csv_stat.st_size}.npz"
+    if isfile(cache_path):
+        try:
+            with load(cache_path) as cache:
+                return cache["ts"], cache["status"]
+        except (OSError, ValueError, KeyError, BadZipFile):
+            # A damaged cache is ignored, and replaced below
+            pass
+
     with open(DOOR_CSV_PATH, "r") as file:
-        csv_reader = reader(file, delimiter=",")
-        return [
-            (int(row[STATUS]), datetime.strptime(row[TS], DATETIME_FMT))
-            for row in csv_reader
-        ]
+        rows = list(reader(file, delimiter=","))
+    ts = array([row[1] for row in rows], dtype="datetime64[s]").view("int64")
+    status = array([row[0] for row in rows], dtype=uint8)
+
+    # Write to a temporary file first, so an interrupted write can't leave a damaged
+    # cache behind under a valid name
+    try:
+        fd, tmp_path = mkstemp(dir=dirname(cache_path), suffix=".tmp")
+        try:
+            with fdopen(fd, "wb") as file:
+                savez(file, ts=ts, status=status)
+            # mkstemp creates the file as owner-only, so give it the permissions a
+            # normally created file would get
+            umask_bits = umask(0)
+            umask(umask_bits)
+            chmod(tmp_path, 0o666 & ~umask_bits)
+            replace(tmp_path, cache_path)
+        except BaseException:
+            remove(tmp_path)
+            raise
+    except OSError:
+        # Not being able to write the cache is fine, we just parse it again next time
+        pass
+
+    # Remove caches for earlier versions of door.csv
+    for stale_cache_path in glob(f"{escape(DOOR_CSV_PATH)}.*.npz"):
+        if stale_cache_path != cache_path:
+            try:
+                remove(stale_cache_path)
+            except OSError:
+                pass
+    return ts, status
 
 
-def get_rows(filter_func: callable = None) -> GeneratorType:
+def get_rows(filter_func: callable = None) -> (ndarray, ndarray):
     """
-    Reads door.csv and returns a generator which yields the data one by one.
+    Reads door.csv and returns the data, optionally filtered.
 
-    Call list(get_rows()) to get the whole thing as a list.
+    The filter function is called with the status and timestamp arrays and should
+    return a boolean mask of the rows to keep.
+    """
+    data = get_all_rows()
+    if filter_func is None:
+        return data
+    ts, status = data
+    mask = filter_func(status, ts)
+    return ts[mask], status[mask]
+
+
+def _period_seconds(period: dict) -> int:
+    """
+    Converts a sampling period (timedelta keyword arguments) to a number of seconds.
+
+    The data has a resolution of one second, so the period must be a positive whole
+    number of seconds.
+    """
+    period_td = timedelta(**period)
+    if period_td <= timedelta(0) or period_td.microseconds:
+        raise ValueError(
+            f"Period must be a positive whole number of seconds, got {period_td}"
+        )
+    return int(period_td.total_seconds())
+
+
+def _cumulative_open_time(ts: ndarray, status: ndarray) -> ndarray:
+    """
+    Returns the number of seconds the door was open between the first data point and
+    each data point.
     """
-    for status, timestamp in get_all_rows():
-        if filter_func is None or filter_func(status, timestamp):
-            yield status, timestamp
+    open_duration = diff(ts) * (status[:-1] == OPEN)
+    return concatenate(([0], cumsum(open_duration)))
 
 
-def get_openness(data: list, period: dict) -> (list, list):
+def _open_time_at(
+    ts: ndarray, status: ndarray, cum_open: ndarray, sample_ts: ndarray
+) -> ndarray:
+    """
+    Returns the number of seconds the door was open between the first data point and
+    each sample (which must not be before the first data point).
+    """
+    # Find the last data point at or before each sample, and add the time the door
+    # has been open since that data point
+    idx = searchsorted(ts, sample_ts, side="right") - 1
+    return cum_open[idx] + where(status[idx] == OPEN, sample_ts - ts[idx], 0)
+
+
+def _openness_kernel(ts: ndarray, status: ndarray, period_s: int) -> (ndarray, ndarray):
+    """
+    Computes the openness for each sampling period.
+
+    :param ts: Timestamps (seconds since epoch) of the data points, sorted
+    :param status: Status of each data point
+    :param period_s: Sampling period in seconds
+    :return: Timestamp (seconds since epoch) at the end of each sampling period, and
+        the openness in that period
+    """
+    # The data points are irregularly spaced, so instead of walking through them we
+    # integrate the time the door has been open.
+    cum_open = _cumulative_open_time(ts, status)
+
+    # Take regular samples from the first to the last data point
+    sample_grid = arange(ts[0], ts[-1] + 1, period_s)
+    cum_open_at_sample = _open_time_at(ts, status, cum_open, sample_grid)
+
+    # The openness in each period is the open time within the period, normalized.
+    # Single precision is plenty for a fraction that is only plotted and averaged.
+    openness = divide(diff(cum_open_at_sample), period_s, dtype=float32)
+    return sample_grid[1:], openness
+
+
+def _semester_kernel(
+    ts: ndarray, status: ndarray, edges_s: ndarray, period_s: int
+) -> (ndarray, ndarray, ndarray):
+    """
+    Computes the openness for each sampling period in every semester in one go.
+
+    Each semester is sampled as if _openness_kernel was called with only the data
+    points strictly between its edges. Within those data points the open time is
+    the same as for the full data, so a single cumulative sum and searchsorted can be
+    shared between all the semesters.
+
+    :param ts: Timestamps (seconds since epoch) of the data points, sorted
+    :param status: Status of each data point
+    :param edges_s: Timestamps (seconds since epoch) of the semester boundaries
+    :param period_s: Sampling period in seconds
+    :return: Timestamps and opennesses for all the semesters concatenated, and the
+        number of samples in each semester. Semesters without data are left out.
+    """
+    # Find the first and last data point strictly between each pair of boundaries
+    first_idx = searchsorted(ts, edges_s, side="right")[:-1]
+    last_idx = searchsorted(ts, edges_s, side="left")[1:] - 1
+    has_data = first_idx <= last_idx
+    first_ts = ts[first_idx[has_data]]
+    last_ts = ts[last_idx[has_data]]
+
+    # Build the sampling grid of every semester, each starting at its first data point
+    num_samples = (last_ts - first_ts) // period_s
+    num_points = num_samples + 1
+    semester = repeat(arange(len(num_points)), num_points)
+    segment_start = repeat(cumsum(num_points) - num_points, num_points)
+    sample_index = arange(num_points.sum()) - segment_start
+    sample_grid = first_ts[semester] + sample_index * period_s
+
+    # Take the differences within each semester, skipping the ones across semesters
+    cum_open = _cumulative_open_time(ts, status)
+    cum_open_at_sample = _open_time_at(ts, status, cum_open, sample_grid)
+    openness = divide(diff(cum_open_at_sample), period_s, dtype=float32)
+    within_semester = sample_index[1:] > 0
+    return sample_grid[1:][within_semester], openness[within_semester], num_samples
+
+
+# Cached results of get_openness, keyed on the id of the data and the period, in least
+# recently used order. Each entry holds on to its data, which ensures that the id isn't
+# reused for other data while the entry exists.
+_OPENNESS_CACHE = OrderedDict()
+_OPENNESS_CACHE_SIZE = 8
+
+
+def get_openness(data: tuple, period: dict) -> (ndarray, ndarray):
     """
     Extracts the openness from the raw data.
 
+    The result is cached for each data object and period, so the data must not be
+    modified after it has been passed here.
+
     :param data: Raw data
     :param period: Period over which to average the openness
-    :return: datetimes (x-axis) and opennesses (y-axis)
-    """
-    # Init state
-    min_date = data[0][TS]
-    max_date = data[-1][TS]
-
-    openness = []
-    datetimes = []
-
-    # And now for the tricky bit!
-    # We take regular samples, but the data points will be irregularly spaced, so
-    # there may be zero, one or many samples between each data point.
-    # This algorithm uses 4 "cursors": one for the current and previous sampling point,
-    # and one for the current and previous data point.
-
-    # Initialize the cursors
-    prev_idx = 0
-    cur_idx = 1
-    prev_data = data[prev_idx][TS]
-    cur_data = data[cur_idx][TS]
-    prev_sample = min_date
-    cur_sample = min_date + timedelta(**period)
-
-    # Iterate through the sampling period
-    while cur_sample <= max_date:
-        # If the current datapoint is beyond the current date, we assign a 1.0 or a
-        # 0.0 to the current sample (the door was closed or open for the full period)
-        if cur_data > cur_sample:
-            if data[prev_idx][STATUS] == OPEN:
-                cur_openness = 1.0
-            else:
-                cur_openness = 0.0
-        # Otherwise, there is one or more sample within the current sample period.
-        else:
-            # Initialize the openness at 0
-            cur_openness = 0.0
-
-            # Iterate through every row until we reach the current sample
-            while cur_data <= cur_sample:
-                # Add openness proportional to the time that the door was open
-                if data[prev_idx][STATUS] == OPEN:
-                    cur_openness += (cur_data - prev_data) / (cur_sample - prev_sample)
-
-                # Increment data indices
-                prev_idx = cur_idx
-                cur_idx += 1
-                if cur_idx >= len(data):
-                    break
-
-                # Increment data cursors
-                prev_data = data[prev_idx][TS]
-                cur_data = data[cur_idx][TS]
-
-            # This would need to be explained with a drawing
-            if data[prev_idx][STATUS] == OPEN:
-                cur_openness += (cur_sample - prev_data) / (cur_sample - prev_sample)
-
-        # Snap prev_data cursor to the sampling grid
-        prev_data = cur_sample
-
-        # Add data for this sampling point
-        openness.append(cur_openness)
-        datetimes.append(cur_sample)
-
-        # Increment sample cursors
-        prev_sample = cur_sample
-        cur_sample += timedelta(**period)
-
-    return datetimes, openness
-
-
-def get_openness_by_hour(data: list, period: dict) -> list:
+    :return: datetimes (x-axis) and opennesses (y-axis), both read-only
+    """
+    key = (id(data), tuple(sorted(period.items())))
+    entry = _OPENNESS_CACHE.get(key)
+    if entry is not None and entry[0] is data:
+        _OPENNESS_CACHE.move_to_end(key)
+        return entry[1]
+
+    ts, status = data
+    period_s = _period_seconds(period)
+    sample_ts, openness = _openness_kernel(ts, status, period_s)
+    datetimes = sample_ts.astype("datetime64[s]")
+    datetimes.setflags(write=False)
+    openness.setflags(write=False)
+    result = (datetimes, openness)
+
+    _OPENNESS_CACHE[key] = (data, result)
+    _OPENNESS_CACHE.move_to_end(key)
+    while len(_OPENNESS_CACHE) > _OPENNESS_CACHE_SIZE:
+        _OPENNESS_CACHE.popitem(last=False)
+    return result
+
+
+def hour_of_day(datetimes: ndarray) -> ndarray:
+    """
+    Returns the hour of the day (0 to 23) for each datetime64 in the array
+    """
+    return ((datetimes.astype("datetime64[s]").view("int64") // 3600) % 24).astype(intp)
+
+
+def day_of_week(datetimes: ndarray) -> ndarray:
+    """
+    Returns the weekday (0 is Monday, 6 is Sunday) for each datetime64 in the array
+    """
+    # The epoch (1970-01-01) was a Thursday
+    days = datetimes.astype("datetime64[s]").view("int64") // (24 * 3600)
+    return ((days + 3) % 7).astype(intp)
+
+
+def average_by_bin(bins: ndarray, values: ndarray, num_bins: int) -> ndarray:
+    """
+    Averages the values that fall in each bin. Empty bins are set to 0.
+
+    The sums are accumulated in double precision even if the values are single
+    precision.
+
+    :param bins: Bin index for each value
+    :param values: Values to average
+    :param num_bins: Number of bins
+    :return: An array with the average value in each bin
+    """
+    sums = bincount(bins, weights=values, minlength=num_bins)
+    counts = bincount(bins, minlength=num_bins)
+    # bincount returns integer sums when there are no values, so the output is always
+    # allocated as floats
+    return divide(sums, counts, out=zeros(num_bins, dtype=float64), where=counts > 0)
+
+
+def get_openness_by_hour(data: tuple, period: dict) -> ndarray:
     """
     Extracts the openness by hour from the raw data.
 
     :param data: Raw data
     :param period: Period over which to average the openness
-    :return: A list with 25 entries (bins[7] is for 07:00, bins[15] for 15:00, and so on)
+    :return: An array with 25 entries (bins[7] is for 07:00, bins[15] for 15:00, etc.)
     """
-    # Init bins
-    hour_bins = [0] * (24 + 1)
-    num_samples_by_hour = [0] * (24 + 1)
-
-    # Get opennesses for each weekday
-    for dt, openness in zip(*get_openness(data, period)):
-        h = dt.hour + 1
-        hour_bins[h] += openness
-        num_samples_by_hour[h] += 1
-
-    # Normalize each week bin
-    for h in range(1, 24 + 1):
-        try:
-            hour_bins[h] = hour_bins[h] / num_samples_by_hour[h]
-        except ZeroDivisionError:
-            hour_bins[h] = 0
-    return hour_bins
+    datetimes, openness = get_openness(data, period)
+    return average_by_bin(hour_of_day(datetimes) + 1, openness, 24 + 1)
 
 
-def get_openness_by_weekday(data: list, period: dict) -> list:
+def get_openness_by_weekday(data: tuple, period: dict) -> ndarray:
     """
     Extract the openness by weekday from the raw data.
 
     :param data: Raw data
     :param period: Period over which to average the openness
-    :return: A list with 7 entries (bins[0] is Monday, bins[3] is Thursday, and so on)
+    :return: An array with 7 entries (bins[0] is Monday, bins[3] is Thursday, and so on)
     """
-    # Init state
-    week_bins = [0] * 7
-    num_samples_by_weekday = [0] * 7
+    datetimes, openness = get_openness(data, period)
+    return average_by_bin(day_of_week(datetimes), openness, 7)
 
-    # Get opennesses for each weekday
-    for dt, openness in zip(*get_openness(data, period)):
-        weekday = dt.weekday()
-        week_bins[weekday] += openness
-        num_samples_by_weekday[weekday] += 1
 
-    # Normalize each week bin
-    for w in range(7):
-        try:
-            week_bins[w] = week_bins[w] / num_samples_by_weekday[w]
-        except ZeroDivisionError:
-            week_bins[w] = 0
-    return week_bins
+def _semester_edges() -> ndarray:
+    """
+    Returns the semester boundaries (seconds since epoch) from 2015 until today
+    """
+    # Config
+    today = datetime.today()
+    start_year = 2015
 
+    # Semesters start on January 1st and July 1st
+    years = arange(start_year, today.year + 2)
+    edges = array(
+        [f"{year}-01-01" for year in years] + [f"{year}-07-01" for year in years],
+        dtype="datetime64[s]",
+    )
+    edges.sort()
 
-def get_openness_by_semester(period: dict):
-    # Config
-    stop = datetime.today()
-    start = datetime(2015, 1, 1)
-
-    # Get opennesses for each semester
-    # Maybe optimize this to avoid reading the entire csv-file 6+ times
-    cur_start = start
-    cur_stop = cur_start + relativedelta(months=6)
-    semesters = []
-    while cur_start < stop:
-        # Get openness for the semester
-        rows = list(get_rows(limit_filter_func(cur_start, cur_stop)))
-        if rows:
-            semesters.append(get_openness(rows, period))
-
-        # Update start and stop to next semester
-        cur_start = cur_stop
-        cur_stop += relativedelta(months=6)
-    return semesters
+    # Keep every semester that starts before today
+    num_semesters = searchsorted(edges, datetime64(today, "s"))
+    return edges[: num_semesters + 1].view("int64")
+
+
+def _get_semester_openness(period: dict) -> (ndarray, ndarray, ndarray):
+    """
+    Get raw data and extract the openness for every semester in one go.
+
+    :param period: Period over which to average the openness
+    :return: datetimes and opennesses for all the semesters concatenated, and the
+        number of samples in each semester
+    """
+    ts, status = get_all_rows()
+    sample_ts, openness, num_samples = _semester_kernel(
+        ts, status, _semester_edges(), _period_seconds(period)
+    )
+    return sample_ts.astype("datetime64[s]"), openness, num_samples
+
+
+def get_openness_by_semester(period: dict) -> list:
+    """
+    Get raw data and extract the openness for each semester.
+
+    :param period: Period over which to average the openness
+    :return: A list with datetimes and opennesses for each semester
+    """
+    datetimes, openness, num_samples = _get_semester_openness(period)
+    if len(num_samples) == 0:
+        return []
+
+    # Split the result by semester
+    split_idx = cumsum(num_samples)[:-1]
+    return list(zip(split(datetimes, split_idx), split(openness, split_idx)))
 
 
 def get_openness_by_weekday_by_semester(period: dict) -> list:
@@ -212,50 +387,33 @@ def get_openness_by_weekday_by_semester(period: dict) -> list:
     :param period: Period over which to average the openness
     :return: A list of data organized by semester
     """
-    # Get openness by semester
-    semesters = get_openness_by_semester(period)
+    datetimes, openness, num_samples = _get_semester_openness(period)
+    if len(num_samples) == 0:
+        return []
 
-    # Place opennesses in bins by weekday
-    dataseries = []
-    for datetimes, opennesses in semesters:
-        week_bins = [0] * 7
-        num_samples_by_weekday = [0] * 7
+    # Place opennesses in bins by semester and weekday
+    num_semesters = len(num_samples)
+    semester = repeat(arange(num_semesters), num_samples)
+    weekday = day_of_week(datetimes)
+    week_bins = average_by_bin(semester * 7 + weekday, openness, num_semesters * 7)
+    return list(week_bins.reshape(num_semesters, 7))
 
-        # Get opennesses for each weekday
-        for dt, openness in zip(datetimes, opennesses):
-            weekday = dt.weekday()
-            week_bins[weekday] += openness
-            num_samples_by_weekday[weekday] += 1
 
-        # Normalize each week bin
-        for i in range(7):
-            try:
-                week_bins[i] = week_bins[i] / num_samples_by_weekday[i]
-            except ZeroDivisionError:
-                week_bins[i] = 0
-        dataseries.append(week_bins)
-    return dataseries
-
-
-def get_visit_durations(data: list) -> list:
+def get_visit_durations(data: tuple) -> ndarray:
     """
     Extract the visit durations from the raw data.
 
     :param data: Raw data
-    :return: A list of the durations for every visit
-    """
-    # Set init status
-    prev_timestamp = data[0][TS]
-    prev_status = CLOSED
-    visit_start = prev_timestamp
-
-    # Find visit durations
-    durations = []
-    for [status, timestamp] in data[1:]:
-        if status == OPEN and prev_status == CLOSED:
-            visit_start = timestamp
-        elif status == CLOSED and prev_status == OPEN:
-            durations.append((timestamp - visit_start).total_seconds())
-        prev_status = status
-
-    return durations
+    :return: An array of the durations (in seconds) for every visit
+    """
+    # A visit starts when the door goes from closed to open, and ends when it goes
+    # from open to closed. The first data point is skipped and the door is assumed to
+    # be closed before the second one.
+    ts, status = data
+    transitions = diff(concatenate(([CLOSED], status[1:])).astype(int8))
+    starts = ts[1:][transitions == OPEN - CLOSED]
+    ends = ts[1:][transitions == CLOSED - OPEN]
+
+    # Starts and ends alternate, beginning with a start, so there may be one start too
+    # many at the end
+    return (ends - starts[: len(ends)]).astype(float64)